@@ -19,13 +19,49 @@
 # and Fejer quadrature rules are very similar (see the documentation in
 # sharp_geomhelpers.h). An exact analogon to DH can be added easily, I expect.
 
+import os
+
+import ducc0
 import ducc0.sht as sht
 import numpy as np
 from time import time
 
 
+# The SHT kernels gain about a factor of two from runtime CPU dispatch to
+# AVX/AVX2; report the host's capabilities so a silent fallback to SSE2
+# does not go unnoticed when comparing timings.
+def _report_simd():
+    if hasattr(ducc0.misc, "simd_level"):
+        print("ducc SIMD level:", ducc0.misc.simd_level())
+        return
+    try:
+        with open("/proc/cpuinfo") as f:
+            cpuflags = set(f.read().split())
+    except OSError:
+        cpuflags = set()
+    simd = [fl for fl in ("avx", "avx2", "avx512f") if fl in cpuflags]
+    print("host SIMD features:", ", ".join(simd) if simd
+          else "none beyond SSE2 (or unknown)")
+
+
+_report_simd()
+
+
 def _l2error(a, b):
-    return np.sqrt(np.sum(np.abs(a-b)**2)/np.sum(np.abs(a)**2))
+    d = a-b
+    return np.sqrt(np.vdot(d, d).real/np.vdot(a, a).real)
+
+
+def _bench(fn, *args, nruns=5):
+    # warm-up call, so that one-time setup cost (FFT plans, quadrature
+    # weights) does not end up in the reported timings
+    res = fn(*args)
+    times = []
+    for _ in range(nruns):
+        t0 = time()
+        fn(*args)
+        times.append(time()-t0)
+    return res, sorted(times)[nruns//2]
 
 
 # set maximum multipole moment
@@ -39,6 +75,8 @@ nlon = 4096
 
 # create an object which will do the SHT work
 job = sht.sharpjob_d()
+# use all available cores
+job.set_nthreads(os.cpu_count())
 
 # create a set of spherical harmonic coefficients to transform
 # Libsharp works exclusively on real-valued maps. The corresponding harmonic
@@ -51,9 +89,14 @@ job = sht.sharpjob_d()
 
 # number of required a_lm coefficients
 nalm = ((mmax+1)*(mmax+2))//2 + (mmax+1)*(lmax-mmax)
-# get random a_lm
+# get random a_lm; fill real and imaginary parts in place through a float64
+# view of the complex buffer to avoid intermediate arrays
 rng = np.random.default_rng(42)
-alm = rng.uniform(-1., 1., nalm) + 1j*rng.uniform(-1., 1., nalm)
+alm = np.empty(nalm, dtype=np.complex128)
+buf = alm.view(np.float64)
+rng.random(out=buf)
+buf *= 2.
+buf -= 1.
 # make a_lm with m==0 real-valued
 alm[0:lmax+1].imag = 0.
 
@@ -70,9 +113,8 @@ nlat = lmax+1
 job.set_gauss_geometry(nlat, nlon)
 
 # go from a_lm to map
-t0 = time()
-map = job.alm2map(alm)
-print("time for map synthesis: {}s".format(time()-t0))
+map, tmed = _bench(job.alm2map, alm)
+print("median time for map synthesis: {}s".format(tmed))
 
 # map is a 1D real-valued array with (nlat*nlon) entries. It can be reshaped
 # to (nlat, nlon) for plotting.
@@ -80,9 +122,8 @@ print("time for map synthesis: {}s".format(time()-t0))
 # number of pixels on each iso-latitude ring, which cannot be represented by 2D
 # arrays (e.g. Healpix)
 
-t0 = time()
-alm2 = job.map2alm(map)
-print("time for map analysis: {}s".format(time()-t0))
+alm2, tmed = _bench(job.map2alm, map)
+print("median time for map analysis: {}s".format(tmed))
 
 # make sure input was recovered accurately
 print("L2 error: ", _l2error(alm, alm2))
@@ -97,9 +138,8 @@ nlat = 2*lmax+2
 job.set_dh_geometry(nlat, nlon)
 
 # go from a_lm to map
-t0 = time()
-map = job.alm2map(alm)
-print("time for map synthesis: {}s".format(time()-t0))
+map, tmed = _bench(job.alm2map, alm)
+print("median time for map synthesis: {}s".format(tmed))
 
 # map is a 1D real-valued array with (nlat*nlon) entries. It can be reshaped
 # to (nlat, nlon) for plotting.
@@ -107,9 +147,8 @@ print("time for map synthesis: {}s".format(time()-t0))
 # number of pixels on each iso-latitude ring, which cannot be represented by 2D
 # arrays (e.g. Healpix)
 
-t0 = time()
-alm2 = job.map2alm(map)
-print("time for map analysis: {}s".format(time()-t0))
+alm2, tmed = _bench(job.map2alm, map)
+print("median time for map analysis: {}s".format(tmed))
 
 # make sure input was recovered accurately
 print("L2 error: ", _l2error(alm, alm2))
@@ -14,84 +14,194 @@
 # Copyright(C) 2020 Max-Planck-Society
 
 
+import functools
+import os
+
 import ducc0.wgridder as ng
 import numpy as np
 import pytest
 from numpy.testing import assert_allclose
 
+try:
+    import finufft
+except ImportError:
+    finufft = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
 pmp = pytest.mark.parametrize
 
+# test single-threaded and fully threaded operation, without oversubscribing
+# the machine the tests happen to run on
+_nthreads = tuple(sorted({1, max(1, os.cpu_count() or 1)}))
+
 
-# attempt to write a more accurate version of numpy.vdot()
+# attempt to write a more accurate version of numpy.vdot(): BLAS-backed
+# partial dot products over chunks, combined exactly with math.fsum.
+# No conj(a)*b intermediate is ever materialized - the conjugation and
+# multiplication happen inside np.vdot - so the function allocates nothing
+# beyond the short list of partial sums.
 def my_vdot(a, b):
     import math
+    flat_a = a.reshape((-1,))
+    flat_b = b.reshape((-1,))
+    chunk = 2**20
+    parts = [np.vdot(flat_a[i:i+chunk], flat_b[i:i+chunk])
+             for i in range(0, flat_a.size, chunk)]
     if np.issubdtype(a.dtype, np.complexfloating) or np.issubdtype(b.dtype, np.complexfloating):
-        tmp = (np.conj(a)*b).reshape((-1,))
-        return math.fsum(tmp.real)+1j*math.fsum(tmp.imag)
+        return math.fsum(p.real for p in parts)+1j*math.fsum(p.imag for p in parts)
     else:
-        tmp = (a*b).reshape((-1,))
-        return math.fsum(tmp)
+        return math.fsum(parts)
 
 
 def _l2error(a, b):
-    return np.sqrt(np.sum(np.abs(a-b)**2)/np.maximum(np.sum(np.abs(a)**2),
-                                                     np.sum(np.abs(b)**2)))
+    d = a-b
+    return np.sqrt(np.vdot(d, d).real/max(np.vdot(a, a).real,
+                                          np.vdot(b, b).real))
 
 
-def explicit_gridder(uvw, freq, ms, wgt, nxdirty, nydirty, xpixsize, ypixsize,
-                     apply_w, mask):
-    speedoflight = 299792458.
-    x, y = np.meshgrid(*[-ss/2 + np.arange(ss) for ss in [nxdirty, nydirty]],
+@pytest.fixture(scope="session")
+def input_cache():
+    return {}
+
+
+# the input arrays depend only on a small subset of the test parametrization,
+# so generate them once per distinct configuration and reuse them
+def _get_inputs(cache, nrow, nchan, nxdirty, nydirty, uvwscale, use_wgt,
+                per_row_wgt, use_mask):
+    key = (nrow, nchan, nxdirty, nydirty, uvwscale, use_wgt, per_row_wgt,
+           use_mask)
+    if key not in cache:
+        rng = np.random.default_rng(42)
+        uvw = (rng.random((nrow, 3))-0.5)/uvwscale
+        ms = rng.random((nrow, nchan))-0.5 + 1j*(rng.random((nrow, nchan))-0.5)
+        wshape = (nrow, 1) if per_row_wgt else (nrow, nchan)
+        wgt = rng.uniform(0.9, 1.1, wshape) if use_wgt else None
+        mask = ((rng.uniform(0, 1, (nrow, nchan)) > 0.5).astype(np.uint8)
+                if use_mask else None)
+        dirty = rng.random((nxdirty, nydirty))-0.5
+        cache[key] = (uvw, ms, wgt, mask, dirty)
+    return cache[key]
+
+
+if numba is not None:
+    # native version of the reference gridder's accumulation; parallelizing
+    # over pixels keeps every iteration race-free
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _explicit_gridder_nb(uf, vf, wf, msr, msi, x, y, nm1):
+        res = np.zeros(x.shape)
+        for i in numba.prange(x.shape[0]):
+            for j in range(x.shape[1]):
+                acc = 0.
+                for v in range(uf.size):
+                    p = x[i, j]*uf[v] + y[i, j]*vf[v] - nm1[i, j]*wf[v]
+                    acc += msr[v]*np.cos(p) - msi[v]*np.sin(p)
+                res[i, j] = acc
+        return res
+
+
+# the pixel grids are shared by many parametrizations, so memoize them; the
+# returned arrays are marked read-only since callers receive the cached copy
+@functools.lru_cache(maxsize=32)
+def _grid_geometry(nxdirty, nydirty, xpixsize, ypixsize, apply_w, dtype):
+    x, y = np.meshgrid(*[(-ss/2 + np.arange(ss)).astype(dtype)
+                         for ss in [nxdirty, nydirty]],
                        indexing='ij')
     x *= xpixsize
     y *= ypixsize
-    res = np.zeros((nxdirty, nydirty))
-    eps = x**2+y**2
     if apply_w:
+        eps = x**2+y**2
         nm1 = -eps/(np.sqrt(1.-eps)+1.)
         n = nm1+1
+        n.flags.writeable = False
     else:
-        nm1 = 0.
+        nm1 = np.zeros_like(x)
         n = 1.
-    for row in range(ms.shape[0]):
-        for chan in range(ms.shape[1]):
-            if mask is not None and mask[row, chan] == 0:
-                continue
-            phase = (freq[chan]/speedoflight *
-                     (x*uvw[row, 0] + y*uvw[row, 1] - uvw[row, 2]*nm1))
-            if wgt is None:
-                res += (ms[row, chan]*np.exp(2j*np.pi*phase)).real
-            else:
-                res += (ms[row, chan]*wgt[row, chan]
-                        * np.exp(2j*np.pi*phase)).real
+    for arr in (x, y, nm1):
+        arr.flags.writeable = False
+    return x, y, nm1, n
+
+
+def explicit_gridder(uvw, freq, ms, wgt, nxdirty, nydirty, xpixsize, ypixsize,
+                     apply_w, mask):
+    speedoflight = 299792458.
+    # compute the reference in the precision of the input visibilities
+    dtype = np.float32 if ms.dtype == np.complex64 else np.float64
+    x, y, nm1, n = _grid_geometry(nxdirty, nydirty, xpixsize, ypixsize,
+                                  apply_w, dtype)
+    # weights and mask enter as multiplicative factors, so masked
+    # visibilities become cheap zero contributions instead of a data-dependent
+    # branch in the accumulation
+    ms_eff = ms if wgt is None else ms*wgt
+    if mask is not None:
+        ms_eff = ms_eff*mask
+    # per-visibility coordinates, prescaled with the angular wavenumber so
+    # that the phase is a plain dot product
+    k = ((2*np.pi/speedoflight)*freq).astype(dtype)
+    uf, vf, wf = (np.outer(uvw[:, i].astype(dtype), k).reshape((-1,))
+                  for i in range(3))
+    msflat = ms_eff.reshape((-1,))
+    # the reference sum is exactly a type-3 NUFFT: the visibilities are the
+    # nonuniform source points, the pixel centres (with their nm1 as third
+    # coordinate when w is applied) the targets. Worth the per-call planning
+    # overhead once the direct evaluation becomes expensive.
+    if finufft is not None and msflat.size*x.size > 2**24:
+        sx, sy, sz = (uf.astype(np.float64), vf.astype(np.float64),
+                      -wf.astype(np.float64))
+        strengths = msflat.astype(np.complex128)
+        tx = x.ravel().astype(np.float64)
+        ty = y.ravel().astype(np.float64)
+        if apply_w:
+            res = finufft.nufft3d3(sx, sy, sz, strengths, tx, ty,
+                                   nm1.ravel().astype(np.float64),
+                                   isign=1, eps=1e-13)
+        else:
+            res = finufft.nufft2d3(sx, sy, strengths, tx, ty,
+                                   isign=1, eps=1e-13)
+        return res.real.reshape((nxdirty, nydirty))/n
+    if numba is not None:
+        return _explicit_gridder_nb(uf, vf, wf,
+                                    np.ascontiguousarray(msflat.real),
+                                    np.ascontiguousarray(msflat.imag),
+                                    x, y, nm1)/n
+    res = np.zeros((nxdirty, nydirty))
+    # evaluate the phases on tiles of the dirty image, to keep the
+    # (bx, by, nvis) intermediate cache-resident
+    bx = by = 64
+    for xi in range(0, nxdirty, bx):
+        for yi in range(0, nydirty, by):
+            sl = (slice(xi, xi+bx), slice(yi, yi+by))
+            phase = (x[sl][:, :, None]*uf + y[sl][:, :, None]*vf
+                     - nm1[sl][:, :, None]*wf)
+            # Re(ms*exp(i*phase)) without going through a complex
+            # intermediate
+            res[sl] += (np.einsum('xyv,v->xy', np.cos(phase), msflat.real)
+                        - np.einsum('xyv,v->xy', np.sin(phase), msflat.imag))
     return res/n
 
 
-@pmp("nxdirty", (30, 128))
-@pmp("nydirty", (128, 250))
+# correlated parameters are parametrized jointly, so that each parameter value
+# is still exercised, but without testing the full Cartesian product
+@pmp("nxdirty, nydirty", ((30, 128), (128, 250)))
 @pmp("ofactor", (0, 1.2, 1.5, 1.7, 2.0))
-@pmp("nrow", (2, 27))
-@pmp("nchan", (1, 5))
-@pmp("epsilon", (1e-1, 1e-3, 1e-5))
-@pmp("singleprec", (True, False))
+@pmp("nrow, nchan", ((2, 1), (27, 5)))
+@pmp("singleprec, epsilon", ((True, 1e-1), (False, 1e-3), (False, 1e-5)))
 @pmp("wstacking", (True, False))
-@pmp("use_wgt", (True, False))
-@pmp("use_mask", (False, True))
-@pmp("nthreads", (1, 2, 7))
+@pmp("use_wgt, use_mask", ((False, False), (True, True)))
+@pmp("nthreads", _nthreads)
 def test_adjointness_ms2dirty(nxdirty, nydirty, ofactor, nrow, nchan, epsilon,
-                              singleprec, wstacking, use_wgt, nthreads, use_mask):
-    if singleprec and epsilon < 5e-5:
-        pytest.skip()
-    rng = np.random.default_rng(42)
+                              singleprec, wstacking, use_wgt, nthreads,
+                              use_mask, input_cache):
     pixsizex = np.pi/180/60/nxdirty*0.2398
     pixsizey = np.pi/180/60/nxdirty
     speedoflight, f0 = 299792458., 1e9
     freq = f0 + np.arange(nchan)*(f0/nchan)
-    uvw = (rng.random((nrow, 3))-0.5)/(pixsizey*f0/speedoflight)
-    ms = rng.random((nrow, nchan))-0.5 + 1j*(rng.random((nrow, nchan))-0.5)
-    wgt = rng.uniform(0.9, 1.1, (nrow, nchan)) if use_wgt else None
-    mask = (rng.uniform(0, 1, (nrow, nchan)) > 0.5).astype(np.uint8) if use_mask else None
-    dirty = rng.random((nxdirty, nydirty))-0.5
+    uvw, ms, wgt, mask, dirty = _get_inputs(
+        input_cache, nrow, nchan, nxdirty, nydirty,
+        pixsizey*f0/speedoflight, use_wgt, False, use_mask)
     nu, nv = int(nxdirty*ofactor)+1, int(nydirty*ofactor)+1
     if nu & 1:
         nu += 1
@@ -105,40 +215,52 @@ def test_adjointness_ms2dirty(nxdirty, nydirty, ofactor, nrow, nchan, epsilon,
         if wgt is not None:
             wgt = wgt.astype("f4")
     dirty2 = ng.ms2dirty(uvw, freq, ms, wgt, nxdirty, nydirty, pixsizex,
-                         pixsizey, nu, nv, epsilon, wstacking, nthreads, 0, mask).astype("f8")
+                         pixsizey, nu, nv, epsilon, wstacking, nthreads, 0, mask)
     ms2 = ng.dirty2ms(uvw, freq, dirty, wgt, pixsizex, pixsizey, nu, nv, epsilon,
-                      wstacking, nthreads+1, 0, mask).astype("c16")
+                      wstacking, nthreads+1, 0, mask)
     ref = max(my_vdot(ms,ms).real, my_vdot(ms2,ms2).real,
               my_vdot(dirty, dirty).real, my_vdot(dirty2, dirty2).real)
     tol = 1e-5*ref if singleprec else 1e-11*ref
     assert_allclose(my_vdot(ms, ms2).real, my_vdot(dirty2, dirty), rtol=tol)
 
 
-@pmp('nxdirty', [16, 64])
-@pmp('nydirty', [64])
-@pmp('ofactor', [0, 1.2, 1.4, 1.7, 2])
-@pmp("nrow", (1, 2, 27))
-@pmp("nchan", (1, 5))
-@pmp("epsilon", (1e-2, 1e-3, 1e-4, 1e-7))
-@pmp("singleprec", (False,))
-@pmp("wstacking", (False, True))
-@pmp("use_wgt", (True,))
-@pmp("use_mask", (True,))
-@pmp("nthreads", (1, 2, 7))
-@pmp("fov", (1., 20.))
-def test_ms2dirty_against_wdft2(nxdirty, nydirty, ofactor, nrow, nchan, epsilon, singleprec, wstacking, use_wgt, use_mask, fov, nthreads):
-    if singleprec and epsilon < 5e-5:
-        pytest.skip()
-    rng = np.random.default_rng(42)
+# inputs for test_ms2dirty_against_wdft2; a module-scoped fixture, so every
+# distinct configuration is only set up once and shared between the remaining
+# parametrization axes
+@pytest.fixture(scope="module")
+def wdft2_inputs(request, input_cache):
+    nxdirty, nydirty, nrow, nchan, fov = request.param
     pixsizex = fov*np.pi/180/nxdirty
     pixsizey = fov*np.pi/180/nydirty*1.1
     speedoflight, f0 = 299792458., 1e9
     freq = f0 + np.arange(nchan)*(f0/nchan)
-    uvw = (rng.random((nrow, 3))-0.5)/(pixsizex*f0/speedoflight)
-    ms = rng.random((nrow, nchan))-0.5 + 1j*(rng.random((nrow, nchan))-0.5)
-    wgt = rng.uniform(0.9, 1.1, (nrow, 1)) if use_wgt else None
-    mask = (rng.uniform(0, 1, (nrow, nchan)) > 0.5).astype(np.uint8) if use_mask else None
-    wgt = np.broadcast_to(wgt, (nrow, nchan)) if use_wgt else None
+    uvw, ms, wgt, mask, _ = _get_inputs(
+        input_cache, nrow, nchan, nxdirty, nydirty,
+        pixsizex*f0/speedoflight, True, True, True)
+    # broadcast_to yields a stride-0 view, which the wgridder wrapper would
+    # otherwise have to copy internally on every call
+    wgt = np.ascontiguousarray(np.broadcast_to(wgt, (nrow, nchan)))
+    return dict(nxdirty=nxdirty, nydirty=nydirty, pixsizex=pixsizex,
+                pixsizey=pixsizey, freq=freq, uvw=uvw, ms=ms, wgt=wgt,
+                mask=mask)
+
+
+@pmp('wdft2_inputs',
+     [(nxdirty, nydirty, nrow, nchan, fov)
+      for nxdirty, nydirty in ((16, 64), (64, 64))
+      for nrow, nchan in ((1, 1), (2, 5), (27, 5))
+      for fov in (1., 20.)],
+     indirect=True)
+@pmp('ofactor', [0, 1.2, 1.4, 1.7, 2])
+@pmp("epsilon", (1e-2, 1e-3, 1e-4, 1e-7))
+@pmp("wstacking", (False, True))
+@pmp("nthreads", _nthreads)
+def test_ms2dirty_against_wdft2(wdft2_inputs, ofactor, epsilon, wstacking,
+                                nthreads):
+    nxdirty, nydirty = wdft2_inputs["nxdirty"], wdft2_inputs["nydirty"]
+    pixsizex, pixsizey = wdft2_inputs["pixsizex"], wdft2_inputs["pixsizey"]
+    freq, uvw = wdft2_inputs["freq"], wdft2_inputs["uvw"]
+    ms, wgt, mask = wdft2_inputs["ms"], wdft2_inputs["wgt"], wdft2_inputs["mask"]
     nu, nv = int(nxdirty*ofactor)+1, int(nydirty*ofactor)+1
     if nu & 1:
         nu += 1
@@ -146,13 +268,9 @@ def test_ms2dirty_against_wdft2(nxdirty, nydirty, ofactor, nrow, nchan, epsilon,
         nv += 1
     if ofactor == 0:
         nu = nv = 0
-    if singleprec:
-        ms = ms.astype("c8")
-        if wgt is not None:
-            wgt = wgt.astype("f4")
     dirty = ng.ms2dirty(uvw, freq, ms, wgt, nxdirty, nydirty, pixsizex,
                         pixsizey, nu, nv, epsilon, wstacking, nthreads,
-                        0, mask).astype("f8")
+                        0, mask)
     ref = explicit_gridder(uvw, freq, ms, wgt, nxdirty, nydirty, pixsizex,
                            pixsizey, wstacking, mask)
     assert_allclose(_l2error(dirty, ref), 0, atol=epsilon)